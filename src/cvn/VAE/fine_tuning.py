@@ -537,7 +537,7 @@ class Input(nn.Module):
         Preprocessing method
         --------------------
 
-        :param x: [batch_size, w, h, img_channels];
+        :param x: [batch_size, h, w, img_channels];
         :returns: [batch_size, img_channels, h, w]
 
         :type x: torch.Tensor
@@ -545,8 +545,9 @@ class Input(nn.Module):
         """
         assert x.shape[-1] in (1, 3), (
             f"Expected 1 or 3 as image channels, but {x.shape[-1]} is got.")
-        # [batch_size, img_channels, h, w]
-        x = x.permute((0, 3, 2, 1))
+        # [batch_size, img_channels, h, w], with the same orientation as
+        # the images seen by the VAE encoder during its training
+        x = x.permute((0, 3, 1, 2))
         x = x.contiguous()
 
         # Resize
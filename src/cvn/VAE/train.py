@@ -36,8 +36,10 @@ __author__ = 'Dr Mokira'
 
 import os
 import math
+import queue
+import random
 import logging
-from shutil import copy
+from copy import deepcopy
 from dataclasses import dataclass
 from argparse import ArgumentParser
 
@@ -49,6 +51,7 @@ from tqdm import tqdm
 
 import torch
 import torch.nn.functional as F
+import torch.multiprocessing as mp
 from torch import nn
 from torchinfo import summary
 
@@ -82,6 +85,7 @@ def set_seed(seed=42):
     :param seed: An integer value;
     :type seed: int
     """
+    random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
@@ -89,6 +93,43 @@ def set_seed(seed=42):
     torch.backends.cudnn.benchmark = False
 
 
+def set_perf_mode():
+    """
+    Enabling the fast paths of the CUDA backends
+
+    The cuDNN autotuner selects the fastest convolution algorithms for
+    the input shapes, which are fixed during the training, and the float32
+    matrix products and convolutions use TF32 tensor cores. The results
+    are no longer bit-wise reproducible, even with the same seed.
+    """
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+
+
+def resolve_amp_dtype(amp_dtype='auto'):
+    """
+    Function to get the type used by the mixed precision
+
+    :param amp_dtype: The name of the type, `bfloat16`, `float16` or `auto`.
+      The `auto` type is bfloat16 on the CUDA devices which support it
+      natively (Ampere and newer), and float16 on the older ones, where
+      bfloat16 is emulated and slower;
+    :returns: The type of the mixed precision.
+
+    :type amp_dtype: `str`
+    :rtype: torch.dtype
+    """
+    if amp_dtype != 'auto':
+        return getattr(torch, amp_dtype)
+    if (torch.cuda.is_available()
+            and torch.cuda.is_bf16_supported(including_emulation=False)):
+        return torch.bfloat16
+    return torch.float16
+
+
 ###############################################################################
 # MODEL IMPLEMENTATION
 ###############################################################################
@@ -113,48 +154,36 @@ class SelfAttention(nn.Module):
         Forward pass
         ------------
         :param x: [batch_size, seq+len, dim];
-        :param causal_mask: Causal mask;
+        :param causal_mask: Causal mask, when it is enabled, the upper
+          triangle of the attention is masked by the attention kernel
+          itself, no mask tensor is allocated;
 
         :type x: torch.Tensor
         :type causal_mask: bool
         :rtype: torch.Tensor
         """
         batch_size, seq_len, d_model = x.shape
-        interim_shape = (batch_size, seq_len, self.n_heads, self.d_heads)
-
-        q, k, v = self.in_proj(x).chunk(3, dim=-1)
-
-        # change the shape of q, k, and v to match the interim shape
-        q = q.view(interim_shape)
-        k = k.view(interim_shape)
-        v = v.view(interim_shape)
-
-        # Swap the elements within matrix using transpose
-        # Take n_heads before seq_len, like that:
-        #   [batch_size, n_heads, seq_len, d_heads]
-        q = q.transpose(1, 2).contiguous()
-        k = k.transpose(1, 2).contiguous()
-        v = v.transpose(1, 2).contiguous()
-
-        # Calculate attention
-        weight = q @ k.transpose(-1, -2)
-
-        if causal_mask:
-            # Mask where the upper traingle (above the principal diagonal) is 1
-            # Fill the upper traingle with -inf
-            mask = torch.ones_like(weight, dtype=torch.bool).triu(1)
-            weight.masked_fill_(mask, -torch.inf)
-
-        weight /= math.sqrt(self.d_heads)
-        weight = F.softmax(weight, dim=-1)
 
+        # Unpack q, k and v from the packed projection in one step:
+        #   [batch_size, seq_len, 3 * d_model]
+        #   -> [3, batch_size, n_heads, seq_len, d_heads]
+        qkv = self.in_proj(x)
+        qkv = qkv.reshape(
+            (batch_size, seq_len, 3, self.n_heads, self.d_heads))
+        qkv = qkv.permute((2, 0, 3, 1, 4))
+        q, k, v = qkv.unbind(0)
+
+        # Calculate attention with the fused kernel, the scaling by
+        # sqrt(d_heads), the causal masking and the softmax are computed
+        # without materializing the [seq_len, seq_len] weight matrix.
         # [batch_size, n_heads, seq_len, d_model / n_heads]
-        output = weight @ v
+        output = F.scaled_dot_product_attention(
+            q, k, v, dropout_p=0.0, is_causal=causal_mask)
 
         # [batch_size, n_heads, seq_len, dd_model / n_heads]
         #   -> [batch_size, seq_len, n_heads, dd_model / n_heads]
         # Change the shape to the shape of out proj
-        output = output.transpose(1, 2).contiguous()
+        output = output.transpose(1, 2)
         output = output.reshape((batch_size, seq_len, d_model))
 
         output = self.out_proj(output)
@@ -170,6 +199,40 @@ def test_self_attention():
     logger.info(str(outputs.shape))
 
 
+def test_self_attention_reference():
+    torch.manual_seed(0)
+    self_attn = SelfAttention(d_model=32, n_heads=4)
+    inputs = torch.randn((2, 10, 32))
+    batch_size, seq_len, d_model = inputs.shape
+    n_heads, d_heads = self_attn.n_heads, self_attn.d_heads
+
+    with torch.no_grad():
+        # Explicit attention: softmax(q @ k.T / sqrt(d_heads)) @ v,
+        # with each of q, k and v split into heads separately
+        q, k, v = self_attn.in_proj(inputs).chunk(3, dim=-1)
+        q, k, v = (
+            t.view((batch_size, seq_len, n_heads, d_heads)).transpose(1, 2)
+            for t in (q, k, v))
+        weight = q @ k.transpose(-1, -2) / math.sqrt(d_heads)
+
+        outputs = {}
+        for causal_mask in (False, True):
+            masked_weight = weight
+            if causal_mask:
+                mask = torch.ones_like(weight, dtype=torch.bool).triu(1)
+                masked_weight = weight.masked_fill(mask, -torch.inf)
+            expected = masked_weight.softmax(dim=-1) @ v
+            expected = expected.transpose(1, 2).reshape(inputs.shape)
+            expected = self_attn.out_proj(expected)
+
+            outputs[causal_mask] = self_attn(inputs, causal_mask=causal_mask)
+            assert torch.allclose(
+                outputs[causal_mask], expected, atol=1e-5)
+
+    # The causal mask is applied
+    assert not torch.allclose(outputs[False], outputs[True], atol=1e-5)
+
+
 class AttentionBlock(nn.Module):
     def __init__(
         self, num_channels, num_groups=32, n_heads=1, in_proj_bias=True,
@@ -190,23 +253,25 @@ class AttentionBlock(nn.Module):
         :type x: torch.Tensor
         :rtype: torch.Tensor
         """
-        residual = x.clone()
+        residual = x
 
         # [batch_size, num_channels, h, w] -> [batch_size, num_channels, h, w]
         x = self.group_norm(x)
 
-        # Reshape and transpose in [batch_size, h * w, num_channels]
+        # Permute and reshape in [batch_size, h * w, num_channels],
+        # with a channels last input, the reshape does not copy the data.
         batch_size, c, h, w = x.shape
-        x = x.view((batch_size, c, h * w))
-        x = x.transpose(-1, -2).contiguous()
+        x = x.permute((0, 2, 3, 1))
+        x = x.reshape((batch_size, h * w, c))
 
         # Perform self attention without causal mask
         # After this operation, we get: [batch_size, h * w, num_channels]
         x = self.attention(x)
 
-        # Transpose and reshape in [batch_size, num_channels, h, w]
-        x = x.transpose(-1, -2).contiguous()
-        x = x.view((batch_size, c, h, w))
+        # Reshape and permute in [batch_size, num_channels, h, w],
+        # the result is a channels last view of the attention output.
+        x = x.reshape((batch_size, h, w, c))
+        x = x.permute((0, 3, 1, 2))
 
         out = residual + x
         return out
@@ -221,6 +286,43 @@ def test_attention_block():
     logger.info(str(outputs.shape))
 
 
+class GroupNormSiLU(nn.GroupNorm):
+    """
+    Group normalization followed by SiLU activation
+
+    The two operations are performed by a single module, it keeps the
+    parameters of `nn.GroupNorm`, so its state dict is the same. When the
+    gradient is not required, the activation is computed in place on the
+    normalized tensor to avoid an activation sized allocation.
+    """
+
+    def forward(self, x):
+        """
+        Forward pass
+        ------------
+
+        :param x: [batch_size, num_channels, h, w];
+        :returns: [batch_size, num_channels, h, w];
+
+        :type x: torch.Tensor
+        :rtype: torch.Tensor
+        """
+        x = F.group_norm(x, self.num_groups, self.weight, self.bias, self.eps)
+        x = F.silu(x, inplace=not torch.is_grad_enabled())
+        return x
+
+
+def test_group_norm_silu():
+    gn_silu = GroupNormSiLU(32, 128)
+    inputs = torch.randn((4, 128, 14, 14))
+    outputs = gn_silu(inputs)
+    expected = F.silu(F.group_norm(inputs, 32, gn_silu.weight, gn_silu.bias))
+
+    assert outputs.shape == (4, 128, 14, 14)
+    assert torch.allclose(outputs, expected)
+    logger.info(str(outputs.shape))
+
+
 class ResidualBlock(nn.Module):
     def __init__(self, in_channels, out_channels, num_groups=32):
         super().__init__()
@@ -261,10 +363,10 @@ class ResidualBlock(nn.Module):
         :type x: torch.Tensor
         :rtype: torch.Tensor
         """
-        residue = x.clone()
+        residue = x
 
         x = self.group_norm1(x)
-        x = F.relu(x)
+        x = F.relu(x, inplace=True)
         x = self.conv1(x)
         x = self.group_norm2(x)
         x = self.conv2(x)
@@ -272,6 +374,31 @@ class ResidualBlock(nn.Module):
         out = x + self.residual_layer(residue)
         return out
 
+    def fuse_group_norm(self):
+        """
+        Method to fold the scale of the second group normalization
+        into the weights of the second convolution
+
+        The group normalization output `gamma * n + beta` is equal to
+        `gamma * (n + beta / gamma)`, so the scale `gamma` is moved into the
+        input channels of the convolution weights, and only the shift
+        `beta / gamma` is kept. The zero padding of the convolution is not
+        affected. The first group normalization can not be folded, because
+        it is followed by a ReLU activation. After this call, the block
+        must be used only for inference, its state dict is changed.
+        """
+        group_norm = self.group_norm2
+        if group_norm.weight is None or group_norm.bias is None:
+            return
+        if not torch.all(group_norm.weight != 0):
+            return
+
+        with torch.no_grad():
+            gamma = group_norm.weight
+            self.conv2.weight.mul_(gamma.view(1, -1, 1, 1))
+            group_norm.bias.div_(gamma)
+        group_norm.weight = None
+
 
 def test_residual_block():
     res_block = ResidualBlock(in_channels=128, out_channels=256)
@@ -282,36 +409,98 @@ def test_residual_block():
     logger.info(str(outputs.shape))
 
 
+def test_residual_block_fuse_group_norm():
+    res_block = ResidualBlock(in_channels=128, out_channels=256)
+    with torch.no_grad():
+        res_block.group_norm2.weight.uniform_(0.5, 1.5)
+        res_block.group_norm2.bias.uniform_(-0.5, 0.5)
+    res_block.eval()
+    inputs = torch.randn((4, 128, 14, 14))
+    with torch.no_grad():
+        expected = res_block(inputs)
+        res_block.fuse_group_norm()
+        outputs = res_block(inputs)
+
+    assert res_block.group_norm2.weight is None
+    assert torch.allclose(outputs, expected, atol=1e-5)
+
+
+class _DownConv(nn.Conv2d):
+    """
+    Stride 2 convolution with an asymmetric padding
+
+    The input is padded on the right and the bottom before the convolution,
+    the padding is part of the module, so no check is needed in the forward
+    pass of the encoder.
+    """
+
+    def forward(self, x):
+        x = F.pad(x, (0, 1, 0, 1))  # (left, right, top, bottom)
+        return super().forward(x)
+
+
+def reparameterize(x, mult_factor=1.0):
+    """
+    Function of re-parameterization trick
+
+    :param x: [n, z_channels, h, w], the mean and the log variance
+      concatenated on the channels dimension;
+    :param mult_factor: The scaling factor of the latent representation;
+    :returns: The latent representation with [n, z_channels / 2, h, w]
+      and the tuple of mean and log variance with [n, z_channels / 2, h, w].
+
+    :type x: torch.Tensor
+    :type mult_factor: `float`
+    :rtype: `tuple`
+    """
+    # We split the tensor x with dim [n, z_channels, h, w]
+    #   into two tensors of equal dimensions:
+    #   [n, z_channels / 2, h, w]
+    mean, log_variance = torch.chunk(x, 2, dim=1)
+
+    # Clamp log variance between -30 and 20
+    log_variance = torch.clamp(log_variance, -30, 20)
+
+    # std = exp(0.5 * log_variance), the exponential is computed in place
+    # on the new tensor, then z = mean + eps * std with a single kernel
+    std = torch.mul(log_variance, 0.5).exp_()
+    z = torch.addcmul(mean, torch.randn_like(std), std)
+
+    out = z.mul_(mult_factor)
+    return out, (mean, log_variance)
+
+
 class Encoder(nn.Sequential):
     def __init__(
         self, img_channels=3, zch=8, num_groups=32, n_heads=1,
         in_proj_bias=True, out_proj_bias=True, mult_factor=0.18215
     ):
         # Conv2D(in_ch, out_ch, ks, s, p)
-        attention_block = AttentionBlock(
-            512, num_groups, n_heads, in_proj_bias, out_proj_bias
-        )
+        # Every layer is a distinct module used once, no weight is shared
+        # with the decoder, the layer indices are those of the state dict.
         super().__init__(
             nn.Conv2d(img_channels, 128, 3, 1, 1), # [n, 128, h, w]
             ResidualBlock(128, 128, num_groups),   # [n, 128, h, w]
-            nn.Conv2d(128, 128, 3, 2, 0),          # [n, 128, h / 2, w / 2]
+            _DownConv(128, 128, 3, 2, 0),          # [n, 128, h / 2, w / 2]
 
             ResidualBlock(128, 256, num_groups), # [n, 256, h / 2, w / 2]
             ResidualBlock(256, 256, num_groups), # [n, 256, h / 2, w / 2]
-            nn.Conv2d(256, 256, 3, 2, 0),        # [n, 256, h / 4, w / 4]
+            _DownConv(256, 256, 3, 2, 0),        # [n, 256, h / 4, w / 4]
 
             ResidualBlock(256, 512, num_groups), # [n, 512, h / 4, w / 4]
             ResidualBlock(512, 512, num_groups), # [n, 512, h / 4, w / 4]
-            nn.Conv2d(512, 512, 3, 2, 0),        # [n, 256, h / 8, w / 8]
+            _DownConv(512, 512, 3, 2, 0),        # [n, 256, h / 8, w / 8]
 
             ResidualBlock(512, 512, num_groups),  # [n, 512, h / 8, w / 8]
             ResidualBlock(512, 512, num_groups),  # [n, 512, h / 8, w / 8]
             ResidualBlock(512, 512, num_groups),  # [n, 512, h / 8, w / 8]
 
-            attention_block,                      # [n, 512, h / 8, w / 8]
+            AttentionBlock(
+                512, num_groups, n_heads, in_proj_bias, out_proj_bias
+            ),                                    # [n, 512, h / 8, w / 8]
             ResidualBlock(512, 512, num_groups),  # [n, 512, h / 8, w / 8]
-            nn.GroupNorm(num_groups, 512),        # [n, 512, h / 8, w / 8]
-            nn.SiLU(),                            # [n, 512, h / 8, w / 8]
+            GroupNormSiLU(num_groups, 512),       # [n, 512, h / 8, w / 8]
+            nn.Identity(),  # Keeps the layer indices of the state dict.
 
             nn.Conv2d(512, zch, 3, 1, 1),  # [n, zch, h / 8, w / 8]
             nn.Conv2d(zch, zch, 1, 1, 0),  # [n, zch, h / 8, w / 8]
@@ -334,25 +523,13 @@ class Encoder(nn.Sequential):
         :type x: torch.Tensor
         :rtype: torch.Tensor
         """
-        for module in self:
-            if isinstance(module, nn.Conv2d) and module.stride == (2, 2):
-                x = F.pad(x, (0, 1, 0, 1))  # (left, right, top, bottom)
-            x = module(x)
-
-        # We split the tensor x with dim [n, z_channels, h / 8, w / 8]
-        #   into two tensors of equal dimensions:
-        #   [n, z_channels / 2, h / 8, w / 8]
-        mean, log_variance = torch.chunk(x, 2, dim=1)
-
-        # Clamp log variance between -30 and 20
-        log_variance = torch.clamp(log_variance, -30, 20)
+        x = super().forward(x)
 
-        # Re-parameterization trick
-        std = torch.exp(0.5 * log_variance)
-        eps = torch.randn_like(std)
-        x = mean + eps * std
-
-        out = x * self.mult_factor
+        # The statistics and the re-parameterization are computed
+        # in float32, even if the forward pass runs in mixed precision.
+        with torch.autocast(x.device.type, enabled=False):
+            x = x.float()
+            out, (mean, log_variance) = reparameterize(x, self.mult_factor)
         return out, (mean, log_variance)
 
 
@@ -371,43 +548,70 @@ def test_encoder():
     logger.info(str(outputs.shape))
 
 
+def upsample_layers(num_channels, upsample_mode='nearest_conv'):
+    """
+    Function to build the layers which double the spatial size of features
+
+    :param num_channels: The number of channels of the features;
+    :param upsample_mode: The upsampling mode, `nearest_conv` for a nearest
+      upsampling followed by a 3x3 convolution, or `convt` for a single
+      4x4 transposed convolution of stride 2. The modes are not
+      numerically equivalent, weights trained with one mode can not be
+      loaded with the other one;
+    :returns: A tuple of two modules. For `convt` mode, the first module
+      is an identity, so that the layer indices of the decoder are the same
+      for the both modes.
+
+    :type num_channels: `int`
+    :type upsample_mode: `str`
+    :rtype: `tuple`
+    """
+    if upsample_mode == 'nearest_conv':
+        return (nn.Upsample(scale_factor=2),
+                nn.Conv2d(num_channels, num_channels, 3, 1, 1))
+    if upsample_mode == 'convt':
+        return (nn.Identity(),
+                nn.ConvTranspose2d(num_channels, num_channels, 4, 2, 1))
+    raise ValueError(
+        f"The upsampling mode named '{upsample_mode}' is not supported.")
+
+
 class Decoder(nn.Sequential):
     def __init__(
         self, img_channels=3, zch=8, num_groups=32, n_heads=1,
-        in_proj_bias=True, out_proj_bias=True, mult_factor=0.18215
+        in_proj_bias=True, out_proj_bias=True, mult_factor=0.18215,
+        upsample_mode='nearest_conv'
     ):
-        attention_block = AttentionBlock(
-            512, num_groups, n_heads, in_proj_bias, out_proj_bias
-        )
+        # Every layer is a distinct module used once, no weight is shared
+        # with the encoder, the layer indices are those of the state dict.
         super().__init__(
             nn.Conv2d(zch // 2, 512, 3, 1, 1),  # [n, 512, h / 8, w / 8]
             ResidualBlock(512, 512),            # [n, 512, h / 8, w / 8]
 
-            attention_block,          # [n, 512, h / 8, w / 8]
+            AttentionBlock(
+                512, num_groups, n_heads, in_proj_bias, out_proj_bias
+            ),                        # [n, 512, h / 8, w / 8]
             ResidualBlock(512, 512),  # [n, 512, h / 8, w / 8]
             ResidualBlock(512, 512),  # [n, 512, h / 8, w / 8]
             ResidualBlock(512, 512),  # [n, 512, h / 8, w / 8]
 
-            nn.Upsample(scale_factor=2),   # [n, 512, h / 4, w / 4]
-            nn.Conv2d(512, 512, 3, 1, 1),  # [n, 512, h / 4, w / 4]
+            *upsample_layers(512, upsample_mode),  # [n, 512, h / 4, w / 4]
             ResidualBlock(512, 512),       # [n, 512, h / 4, w / 4]
             ResidualBlock(512, 512),       # [n, 512, h / 4, w / 4]
             ResidualBlock(512, 512),       # [n, 512, h / 4, w / 4]
 
-            nn.Upsample(scale_factor=2),  # [n, 512, h / 2, w / 2]
-            nn.Conv2d(512, 512, 3, 1, 1), # [n, 512, h / 2, w / 2]
+            *upsample_layers(512, upsample_mode),  # [n, 512, h / 2, w / 2]
             ResidualBlock(512, 256),      # [n, 256, h / 2, w / 2]
             ResidualBlock(256, 256),      # [n, 256, h / 2, w / 2]
             ResidualBlock(256, 256),      # [n, 256, h / 2, w / 2]
 
-            nn.Upsample(scale_factor=2),  # [n, 256, h, w]
-            nn.Conv2d(256, 256, 3, 1, 1), # [n, 256, h, w]
+            *upsample_layers(256, upsample_mode),  # [n, 256, h, w]
             ResidualBlock(256, 128),      # [n, 128, h, w]
             ResidualBlock(128, 128),      # [n, 128, h, w]
             ResidualBlock(128, 128),      # [n, 128, h, w]
 
-            nn.GroupNorm(num_groups, 128),  # [n, 128, h, w]
-            nn.SiLU(),                      # [n, 128, h, w]
+            GroupNormSiLU(num_groups, 128),  # [n, 128, h, w]
+            nn.Identity(),  # Keeps the layer indices of the state dict.
 
             nn.Conv2d(128, img_channels, 3, 1, 1)  # [n, img_channels, h, w]
         )
@@ -429,9 +633,7 @@ class Decoder(nn.Sequential):
         :rtype: torch.Tensor
         """
         x = x / self.mult_factor  # remove the scaling adding by the encoder;
-
-        for module in self:
-            x = module(x)
+        x = super().forward(x)
         return x
 
 
@@ -450,6 +652,27 @@ def test_decoder():
     logger.info(str(outputs.shape))
 
 
+def test_decoder_convt():
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    decoder = Decoder(img_channels=3, upsample_mode='convt')
+    decoder = decoder.to(device)
+
+    inputs = torch.randn((4, 4, 28, 28)).to(device)
+    outputs = decoder(inputs)
+    assert outputs.shape == (4, 3, 224, 224)
+
+    # The layer indices are the same for both upsampling modes
+    assert (decoder.state_dict().keys()
+            == Decoder(img_channels=3).state_dict().keys())
+
+    try:
+        Decoder(img_channels=3, upsample_mode='bilinear')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("An unknown upsampling mode must be refused")
+
+
 class Input(nn.Module):
 
     def __init__(
@@ -479,8 +702,9 @@ class Input(nn.Module):
         Preprocessing method
         --------------------
 
-        :param x: [batch_size, w, h, img_channels];
-        :returns: [batch_size, img_channels, h, w]
+        :param x: [batch_size, h, w, img_channels], in [0, 255];
+        :returns: [batch_size, img_channels, h, w], in channels last
+          memory format.
 
         :type x: torch.Tensor
         :rtype: torch.Tensor
@@ -489,16 +713,17 @@ class Input(nn.Module):
             f"Expected 1 or 3 as image channels, but {x.shape[-1]} is got."
         )
         # [batch_size, img_channels, h, w]
-        x = x.permute((0, 3, 2, 1))
-        x = x.contiguous()
+        x = x.permute((0, 3, 1, 2))
+        x = x.contiguous(memory_format=torch.channels_last)
+
+        # Scale in [0, 1], the normalization below expects it
+        x = x.to(torch.float32, copy=True).div_(255.0)
 
         # Resize
-        # x_size = torch.as_tensor(x.shape[-2:], dtype=torch.int32)
-        # i_size = torch.as_tensor(list(self.img_size), dtype=torch.int32)
-        # x = torch.where(
-        #     torch.all(x_size == i_size), x, TF.resize(x, self.img_size))
-        if x.shape[-2:] != self.img_size:
-            x = TF.resize(x, self.img_size)
+        if tuple(x.shape[-2:]) != tuple(self.img_size):
+            x = F.interpolate(
+                x, size=tuple(self.img_size), mode='bilinear',
+                align_corners=False, antialias=False)
 
         # RGB, Gray scale conversion
         if x.shape[1] == 1 and self.img_channels == 3:
@@ -507,10 +732,6 @@ class Input(nn.Module):
         elif x.shape[1] == 3 and self.img_channels == 1:
             x = TF.rgb_to_grayscale(x, num_output_channels=1)
             # x = TF.normalize(x, [0.5], [0.5])
-
-        # Normalization
-        x = x / 255.0
-        x = x.to(torch.float32)
         return x
 
 
@@ -544,7 +765,7 @@ class Output(nn.Module):
         ----------------------
 
         :param x: [batch_size, img_channels, h, w];
-        :returns: [batch_size, w, h, img_channels]
+        :returns: [batch_size, h, w, img_channels]
 
         :type x: torch.Tensor
         :rtype: torch.Tensor
@@ -558,10 +779,10 @@ class Output(nn.Module):
         if x.shape[1] == 1:
             x = torch.cat([x, x, x], dim=1)
 
-        # [batch_size, img_channels, h, w] -> [batch_size, w, h, img_channels]
-        x = x.permute((0, 3, 2, 1))
-        x = x.contiguous()
-        x = x.to(torch.uint8)
+        # [batch_size, img_channels, h, w] -> [batch_size, h, w, img_channels]
+        # The cast writes a contiguous tensor, no intermediate copy is made.
+        x = x.permute((0, 2, 3, 1))
+        x = x.to(torch.uint8, memory_format=torch.contiguous_format)
         return x
 
 
@@ -575,6 +796,9 @@ class ModelConfig:
     in_proj_bias = True
     out_proj_bias = True
     mult_factor = 0.18215
+    upsample_mode = 'nearest_conv'
+    use_amp = True
+    amp_dtype = 'auto'
 
     def data(self):
         return {"img_channels": self.img_channels,
@@ -584,7 +808,10 @@ class ModelConfig:
                 "n_heads": self.n_heads,
                 "in_proj_bias": self.in_proj_bias,
                 "out_proj_bias": self.out_proj_bias,
-                "mult_factor": self.mult_factor}
+                "mult_factor": self.mult_factor,
+                "upsample_mode": self.upsample_mode,
+                "use_amp": self.use_amp,
+                "amp_dtype": self.amp_dtype}
 
     def save(self, file_path):
         config_data = self.data()
@@ -622,6 +849,7 @@ class VAE(nn.Module):
             in_proj_bias=self.config.in_proj_bias,
             out_proj_bias=self.config.out_proj_bias,
             mult_factor=self.config.mult_factor)
+        self.encoder = self.encoder.to(memory_format=torch.channels_last)
 
     def init_decoder(self):
         self.decoder = Decoder(
@@ -631,7 +859,50 @@ class VAE(nn.Module):
             n_heads=self.config.n_heads,
             in_proj_bias=self.config.in_proj_bias,
             out_proj_bias=self.config.out_proj_bias,
-            mult_factor=self.config.mult_factor)
+            mult_factor=self.config.mult_factor,
+            upsample_mode=self.config.upsample_mode)
+        self.decoder = self.decoder.to(memory_format=torch.channels_last)
+
+    def autocast(self, device):
+        """
+        Function to get the mixed precision context of the forward pass
+
+        :param device: The device on which the forward pass is run;
+        :returns: The autocast context. It is disabled, when the mixed
+          precision is not enabled in the model config or when the device
+          is not a CUDA device.
+
+        :type device: torch.device|`str`
+        :rtype: torch.autocast
+        """
+        device = torch.device(device)
+        amp_dtype = resolve_amp_dtype(self.config.amp_dtype)
+        enabled = self.config.use_amp and device.type == 'cuda'
+        return torch.autocast(device.type, dtype=amp_dtype, enabled=enabled)
+
+    def compile_modules(
+        self, mode='reduce-overhead', fullgraph=False, dynamic=False
+    ):
+        """
+        Function to compile the encoder, the decoder and the preprocessing
+        with `torch.compile`
+
+        The modules are compiled in place, so their state dicts keep
+        the same keys and the saved weights remain loadable.
+
+        :param mode: The compilation mode used by `torch.compile`;
+        :param fullgraph: Whether to fail when the graph is broken;
+        :param dynamic: Whether to compile with dynamic shapes;
+
+        :type mode: `str`
+        :type fullgraph: `bool`
+        :type dynamic: `bool`
+        """
+        self.encoder.compile(mode=mode, fullgraph=fullgraph, dynamic=dynamic)
+        self.decoder.compile(mode=mode, fullgraph=fullgraph, dynamic=dynamic)
+        # The preprocessing is compiled to fuse the cast and the scaling
+        self.input_function.compile(dynamic=dynamic)
+        logger.info(f"Encoder and decoder are compiled with mode '{mode}'")
 
     def forward(self, x):
         """
@@ -647,8 +918,10 @@ class VAE(nn.Module):
         :type x: torch.Tensor
         :rtype: tuple
         """
-        encoded, (mean, log_variance) = self.encoder(x)
-        reconstructed = self.decoder(encoded)
+        x = x.contiguous(memory_format=torch.channels_last)
+        with self.autocast(x.device):
+            encoded, (mean, log_variance) = self.encoder(x)
+            reconstructed = self.decoder(encoded)
         return reconstructed, encoded, (mean, log_variance)
 
 
@@ -669,6 +942,8 @@ def load_module(file_path, module, map_location='cpu'):
     weights = torch.load(
         file_path, weights_only=True, map_location=map_location
     )
+    # The weights are copied into the module parameters, so they are cast
+    # to the parameter type, even if they are saved in half precision.
     module.load_state_dict(weights)
     logger.info(
         f"Model weights of {module.__class__.__name__} loaded successfully!"
@@ -683,6 +958,22 @@ class Model(VAE):
     def device(self):
         return next(self.parameters()).device
 
+    def fuse_for_inference(self):
+        """
+        Method to fold the group normalization scales of the residual
+        blocks into their following convolution
+
+        The model is put in evaluation mode. It must not be trained or
+        saved after this call, since its state dict is changed.
+
+        :rtype: Model
+        """
+        for module in self.modules():
+            if isinstance(module, ResidualBlock):
+                module.fuse_group_norm()
+        self.eval()
+        return self
+
     def summary(self, batch_size=1):
         """
         Function to summary
@@ -706,33 +997,47 @@ class Model(VAE):
         decoder_model_stats = summary(self.decoder, input_data=input_decoder)
         return encoder_model_stats, decoder_model_stats
 
-    def save_encoder(self, file_path):
+    def save_encoder(self, file_path, save_dtype=torch.bfloat16):
         """
         Function to save encoder model weights into file.
 
-        :params file_path: The model file path.
+        :params file_path: The model file path;
+        :param save_dtype: The floating point type in which the weights
+          are stored, the weights are cast back to the parameter type
+          when they are loaded;
+
         :type file_path: `str`
+        :type save_dtype: torch.dtype
         """
         os.makedirs(file_path, exist_ok=True)
         model_file = os.path.join(file_path, 'weights.pth')
         param_file = os.path.join(file_path, 'config.yaml')
 
-        model_weights = self.encoder.state_dict()
+        model_weights = {
+            name: value.to(save_dtype) if value.is_floating_point() else value
+            for name, value in self.encoder.state_dict().items()}
         torch.save(model_weights, model_file)
         self.config.save(param_file)
 
-    def save_decoder(self, file_path):
+    def save_decoder(self, file_path, save_dtype=torch.bfloat16):
         """
         Function to save decoder model weights into file
 
-        :params file_path: The model file path
+        :params file_path: The model file path;
+        :param save_dtype: The floating point type in which the weights
+          are stored, the weights are cast back to the parameter type
+          when they are loaded;
+
         :type file_path: `str`
+        :type save_dtype: torch.dtype
         """
         os.makedirs(file_path, exist_ok=True)
         model_file = os.path.join(file_path, 'weights.pth')
         param_file = os.path.join(file_path, 'config.yaml')
 
-        model_weights = self.decoder.state_dict()
+        model_weights = {
+            name: value.to(save_dtype) if value.is_floating_point() else value
+            for name, value in self.decoder.state_dict().items()}
         torch.save(model_weights, model_file)
         self.config.save(param_file)
 
@@ -786,6 +1091,8 @@ def test_model_save_load():
     assert os.path.isdir("decoder_file") == True
     assert os.path.isfile("decoder_file/config.yaml")
     assert os.path.isfile("decoder_file/weights.pth")
+    weights = torch.load("encoder_file/weights.pth", weights_only=True)
+    assert all(w.dtype == torch.bfloat16 for w in weights.values())
 
     # Load encoder and decoder from file
     loaded_instance = Model.load("encoder_file", "decoder_file")
@@ -811,13 +1118,21 @@ class Dataset(BaseDataset):
     def load_image_files(self):
         """
         Method to load image files from dataset directory provided
+
+        The files are sorted, so that the sample indexes are reproducible.
         """
-        for root, _, files in os.walk(self.dataset_dir):
-            for file in files:
-                if not file.lower().endswith(('.png', '.jpg', '.jpeg')):
-                    continue
-                file = os.path.join(root, file)
-                self.image_files.append(file)
+        extensions = ('png', 'jpg', 'jpeg')
+        directories = [self.dataset_dir]
+        while directories:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file():
+                        _, dot, ext = entry.name.rpartition('.')
+                        if dot and ext.lower() in extensions:
+                            self.image_files.append(entry.path)
+        self.image_files.sort()
 
     def __len__(self):
         # return 5  # For an example
@@ -826,13 +1141,375 @@ class Dataset(BaseDataset):
     def __getitem__(self, item):
         image_file = self.image_files[item]
 
-        image = Image.open(image_file)
-        image = image.convert('RGB')
-        image = image.resize(self.img_size)
-        image = np.asarray(image, dtype=np.uint8)
-        input_image = torch.tensor(image)
-        output_image = torch.tensor(image)
-        return input_image, output_image
+        with Image.open(image_file) as image:
+            image = image.convert('RGB')
+            image = image.resize(self.img_size)
+            image = np.array(image, dtype=np.uint8)
+
+        # The target image is the input image itself, the same tensor is
+        # returned twice, so `collate_images` stacks it into one batch.
+        # If an in-place augmentation is added, the input must be cloned.
+        input_image = torch.from_numpy(image)
+        return input_image, input_image
+
+
+def pack_dataset(dataset, file_path):
+    """
+    Function to pack the images of a dataset into a single NumPy file
+
+    The images are written in uint8 with the shape [num_images, h, w, 3],
+    so that they are read back by memory mapping, without opening and
+    decoding an image file per sample.
+
+    :param dataset: The dataset of images to pack;
+    :param file_path: The path to the `.npy` file to write;
+    :returns: The number of images packed.
+
+    :type dataset: Dataset
+    :type file_path: `str`
+    :rtype: `int`
+    """
+    if len(dataset) == 0:
+        raise ValueError(f"No image found in {dataset.dataset_dir}")
+    first_image, _ = dataset[0]
+    images = np.lib.format.open_memmap(
+        file_path, mode='w+', dtype=np.uint8,
+        shape=(len(dataset), *first_image.shape))
+    images[0] = first_image.numpy()
+    for i in tqdm(range(1, len(dataset)), desc=f"Packing {file_path}"):
+        image, _ = dataset[i]
+        images[i] = image.numpy()
+    images.flush()
+    del images
+    return len(dataset)
+
+
+class MmapDataset(BaseDataset):
+    """
+    Dataset of images packed into a NumPy file by `pack_dataset`
+
+    The file is memory mapped when a sample is first read, so that each
+    worker process of the data loader maps it once.
+
+    :arg file_path: The path to the `.npy` file of the packed images.
+    :type file_path: `str`
+    """
+    def __init__(self, file_path):
+        self.dataset_dir = file_path
+        self.file_path = file_path
+
+        images = np.load(file_path, mmap_mode='r')
+        if images.ndim != 4 or images.dtype != np.uint8:
+            raise ValueError(
+                f"The images of {file_path} must be packed in uint8"
+                " with the shape [num_images, h, w, c]")
+        self.num_images, h, w, _ = images.shape
+        self.img_size = (w, h)
+        del images
+
+        self._images = None
+
+    def __getstate__(self):
+        # The memory mapping is not sent to the worker processes
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return self.num_images
+
+    def __getitem__(self, item):
+        if self._images is None:
+            # The mapping is copy-on-write, so the samples are writable
+            # arrays, although the file is never modified.
+            self._images = np.load(self.file_path, mmap_mode='c')
+        input_image = torch.from_numpy(self._images[item])
+        return input_image, input_image
+
+
+def test_mmap_dataset():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i in range(3):
+            image = np.full((16, 16, 3), i * 50, dtype=np.uint8)
+            Image.fromarray(image).save(os.path.join(tmp_dir, f"{i}.png"))
+
+        dataset = Dataset(tmp_dir, (8, 8))
+        file_path = os.path.join(tmp_dir, "images.npy")
+        assert pack_dataset(dataset, file_path) == 3
+
+        packed_dataset = MmapDataset(file_path)
+        assert len(packed_dataset) == 3
+        assert packed_dataset.img_size == (8, 8)
+        for i in range(3):
+            image, target = packed_dataset[i]
+            assert image.dtype == torch.uint8
+            assert image.shape == (8, 8, 3)
+            assert torch.equal(image, dataset[i][0])
+        del packed_dataset, image, target
+
+
+class InMemoryLoader:
+    """
+    Data loader of a dataset loaded in memory
+
+    All the samples are loaded once and stacked into tensors, then each
+    batch is gathered by indexing these tensors, without per-sample
+    loading and collation.
+
+    :arg dataset: The dataset to load in memory;
+    :arg batch_size: The number of samples per batch;
+    :arg shuffle: Whether to shuffle the samples at each epoch;
+    :arg pin_memory: Whether to return the batches in page-locked memory;
+
+    :type dataset: torch.utils.data.Dataset
+    :type batch_size: `int`
+    :type shuffle: `bool`
+    :type pin_memory: `bool`
+    """
+    def __init__(self, dataset, batch_size=1, shuffle=False, pin_memory=False):
+        if len(dataset) == 0:
+            raise ValueError("The dataset to load in memory is empty")
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pin_memory = pin_memory
+
+        num_samples = len(dataset)
+        inputs, targets = dataset[0]
+        self.inputs = torch.empty(
+            (num_samples, *inputs.shape), dtype=inputs.dtype)
+        # When the targets are the inputs, they are stored only once
+        self.targets = None
+        if targets is not inputs:
+            self.targets = torch.empty(
+                (num_samples, *targets.shape), dtype=targets.dtype)
+
+        for i in range(num_samples):
+            inputs, targets = dataset[i]
+            self.inputs[i] = inputs
+            if self.targets is not None:
+                self.targets[i] = targets
+
+        if self.targets is None:
+            self.targets = self.inputs
+
+    def __len__(self):
+        return math.ceil(self.inputs.shape[0] / self.batch_size)
+
+    def __iter__(self):
+        num_samples = self.inputs.shape[0]
+        if self.shuffle:
+            indexes = torch.randperm(num_samples)
+        else:
+            indexes = torch.arange(num_samples)
+
+        for start in range(0, num_samples, self.batch_size):
+            index = indexes[start:start + self.batch_size]
+            inputs = self.inputs.index_select(0, index)
+            if self.targets is self.inputs:
+                targets = inputs
+            else:
+                targets = self.targets.index_select(0, index)
+
+            if self.pin_memory:
+                inputs = inputs.pin_memory()
+                targets = inputs if targets is inputs else targets.pin_memory()
+            yield inputs, targets
+
+
+def collate_images(samples):
+    """
+    Function to collate the samples of image datasets into a batch
+
+    When the target of every sample is its input tensor, the inputs are
+    stacked once and the same batch is returned as the targets, so it is
+    copied to the device and preprocessed once.
+
+    :param samples: The list of samples, tuples of input and target;
+    :returns: The batch of inputs and the batch of targets.
+
+    :type samples: `list`
+    :rtype: `tuple`
+    """
+    inputs = [sample[0] for sample in samples]
+    if all(target is inputs[i] for i, (_, target) in enumerate(samples)):
+        # The default collation allocates the batch into shared memory,
+        # when it is called in a worker process.
+        batch = data.default_collate(inputs)
+        return batch, batch
+    return data.default_collate(samples)
+
+
+def test_collate_images():
+    image = torch.zeros((8, 8, 3), dtype=torch.uint8)
+    images, targets = collate_images([(image, image), (image, image)])
+    assert images is targets
+    assert images.shape == (2, 8, 8, 3)
+
+    images, targets = collate_images([(image, image.clone())])
+    assert images is not targets
+    assert torch.equal(images, targets)
+
+
+def create_loader(
+    dataset, batch_size, shuffle=False, num_workers=0, max_memory=0,
+    pin_memory=False
+):
+    """
+    Function to create the data loader of a dataset
+
+    :param dataset: The dataset of images;
+    :param batch_size: The number of samples per batch;
+    :param shuffle: Whether to shuffle the samples at each epoch;
+    :param num_workers: The number of worker processes of the data loader;
+    :param max_memory: The maximum size in bytes of the dataset images to
+      load them in memory. When the images of the dataset fit into it, an
+      in-memory loader is returned, otherwise a data loader which reads
+      the image files with worker processes is returned;
+    :param pin_memory: Whether to return the batches in page-locked memory;
+    :returns: The data loader.
+
+    :type dataset: Dataset
+    :type batch_size: `int`
+    :type shuffle: `bool`
+    :type num_workers: `int`
+    :type max_memory: `int`
+    :type pin_memory: `bool`
+    :rtype: InMemoryLoader|torch.utils.data.DataLoader
+    """
+    # The images are RGB images encoded in uint8
+    img_size = dataset.img_size
+    dataset_size = len(dataset) * 3 * img_size[0] * img_size[1]
+    if 0 < dataset_size <= max_memory:
+        logger.info(
+            f"{len(dataset)} images of {dataset.dataset_dir}"
+            " are loaded in memory")
+        return InMemoryLoader(dataset, batch_size, shuffle, pin_memory)
+
+    loader_kwargs = {"num_workers": num_workers, "pin_memory": pin_memory}
+    if num_workers > 0:
+        loader_kwargs["persistent_workers"] = True
+        loader_kwargs["prefetch_factor"] = 4
+    return data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=shuffle,
+        collate_fn=collate_images, **loader_kwargs)
+
+
+class BatchStager:
+    """
+    Stager of the batches copied to the device
+
+    On CUDA devices, the batches are copied into page-locked buffers
+    allocated once, then they are copied asynchronously to the device,
+    instead of pinning a new host buffer for each batch. The buffers are
+    used in turn, and a buffer is reused only when its previous copy
+    to the device is completed.
+
+    :arg device: The device to which the batches are copied;
+    :arg num_slots: The number of page-locked buffers used in turn.
+
+    :type device: torch.device|`str`
+    :type num_slots: `int`
+    """
+    def __init__(self, device, num_slots=2):
+        self.device = torch.device(device)
+        self.num_slots = num_slots
+        self.pinned = self.device.type == 'cuda'
+
+        self._buffers = [[] for _ in range(num_slots)]
+        self._events = [None] * num_slots
+        self._slot = 0
+
+    def release(self):
+        """
+        Method to free the page-locked buffers
+        """
+        for event in self._events:
+            if event is not None:
+                event.synchronize()
+        self._buffers = [[] for _ in range(self.num_slots)]
+        self._events = [None] * self.num_slots
+
+    def _stage(self, buffers, index, tensor):
+        numel = tensor.numel()
+        if index == len(buffers):
+            buffers.append(None)
+        buffer = buffers[index]
+        if (buffer is None or buffer.dtype != tensor.dtype
+                or buffer.numel() < numel):
+            # The buffers are reused by the training and the validation,
+            # so they must not be inference tensors, even when they are
+            # allocated in inference mode.
+            with torch.inference_mode(False):
+                buffer = torch.empty(
+                    numel, dtype=tensor.dtype, pin_memory=self.pinned)
+            buffers[index] = buffer
+
+        # The last batch can be smaller, so a prefix of the buffer is used
+        staged = buffer[:numel].view(tensor.shape)
+        staged.copy_(tensor)
+        return staged.to(self.device, non_blocking=True)
+
+    def __call__(self, *tensors):
+        """
+        Method to copy the tensors of a batch to the device
+
+        :param tensors: The host tensors of the batch;
+        :returns: The device tensors, in the same order. A tensor given
+          several times is copied once.
+
+        :rtype: `tuple`
+        """
+        if not self.pinned:
+            return tuple(t.to(self.device) for t in tensors)
+
+        slot = self._slot
+        self._slot = (slot + 1) % self.num_slots
+        if self._events[slot] is not None:
+            # Wait until the buffers of this slot are read by the device
+            self._events[slot].synchronize()
+
+        outputs = []
+        buffers = self._buffers[slot]
+        num_staged = 0
+        for tensor in tensors:
+            for prev, output in zip(tensors, outputs):
+                if prev is tensor:
+                    break
+            else:
+                output = self._stage(buffers, num_staged, tensor)
+                num_staged += 1
+            outputs.append(output)
+
+        if self._events[slot] is None:
+            self._events[slot] = torch.cuda.Event()
+        self._events[slot].record(torch.cuda.current_stream(self.device))
+        return tuple(outputs)
+
+
+def test_batch_stager():
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    stager = BatchStager(device)
+    small_batch = torch.randint(0, 256, (2, 8, 8, 3), dtype=torch.uint8)
+    large_batch = torch.randint(0, 256, (4, 8, 8, 3), dtype=torch.uint8)
+
+    # The buffers are allocated and grown inside and outside
+    # the inference mode in turn.
+    for in_inference in (True, False, True, False):
+        with torch.inference_mode(in_inference):
+            for batch in (small_batch, large_batch):
+                if stager.pinned:
+                    images, targets = stager(batch, batch)
+                    assert images is targets
+                else:
+                    # The page-locked buffers are only used with CUDA,
+                    # so the staging into a buffer is tested directly.
+                    images = stager._stage(stager._buffers[0], 0, batch)
+                assert torch.equal(images.cpu(), batch)
+                for buffers in stager._buffers:
+                    assert not any(b.is_inference() for b in buffers)
+    stager.release()
 
 
 ###############################################################################
@@ -840,31 +1517,100 @@ class Dataset(BaseDataset):
 ###############################################################################
 
 class AvgMeter:
+    """
+    Average meter of values
 
+    The sum and the count of the values are accumulated into a buffer of
+    two elements, allocated on the device of the first value added, so
+    adding a tensor never synchronizes with the device. The buffer is
+    copied to the host only when the average or the total is read.
+
+    :arg val: The initial total value.
+    :type val: `float`|torch.Tensor
+    """
     def __init__(self, val=0):
-        self.total = val
-        self.count = 0
+        self._buffer = None
+        if val:
+            self._get_buffer(val)[0] += val
+
+    def _get_buffer(self, value):
+        if self._buffer is None:
+            device = None
+            if isinstance(value, torch.Tensor):
+                device = value.device
+            # The sum and the count are accumulated in double precision,
+            # as with Python floats.
+            self._buffer = torch.zeros(2, dtype=torch.float64, device=device)
+        return self._buffer
+
+    @property
+    def total(self):
+        if self._buffer is None:
+            return 0.0
+        return self._buffer[0].item()
+
+    @property
+    def count(self):
+        if self._buffer is None:
+            return 0
+        return int(self._buffer[1].item())
 
     def reset(self):
-        self.total = 0.0
-        self.count = 0
+        # The buffer is allocated again, since the one allocated in
+        # inference mode can not be updated in place outside this mode.
+        self._buffer = None
 
-    def __add__(self, other):
+    def __iadd__(self, other):
         """
-        Add function
+        In-place add function
 
-        :type other: `float`|`int`
+        :type other: `float`|`int`|torch.Tensor
         """
-        self.total += other
-        self.count += 1
+        buffer = self._get_buffer(other)
+        buffer[0] += other
+        buffer[1] += 1
         return self
 
+    def __add__(self, other):
+        """
+        Add function, it returns a new instance of average meter
+
+        :type other: `float`|`int`|torch.Tensor
+        :rtype: AvgMeter
+        """
+        meter = AvgMeter()
+        if self._buffer is not None:
+            meter._buffer = self._buffer.clone()
+        meter += other
+        return meter
+
     def __radd__(self, other):
         return self.__add__(other)
 
+    def update_from_tensor(self, values):
+        """
+        Function to add a batch of values using a single reduction
+
+        :param values: A tensor of values or a list of scalar tensors;
+        :type values: torch.Tensor|`list`
+        """
+        if isinstance(values, (list, tuple)):
+            values = torch.stack(values)
+        buffer = self._get_buffer(values)
+        buffer[0] += values.detach().sum()
+        buffer[1] += values.numel()
+
     def avg(self):
-        if self.count > 0:
-            return self.total / self.count
+        """
+        Function to compute the average, the only one copy from the device
+
+        :rtype: `float`
+        """
+        if self._buffer is None:
+            return 0.0
+        total, count = self._buffer.tolist()
+        if count > 0:
+            return total / count
         else:
             return 0.0
 
@@ -872,7 +1618,43 @@ class AvgMeter:
         return str(self.total)
 
 
+def test_avg_meter():
+    meter = AvgMeter()
+    assert meter.avg() == 0.0
+    meter += torch.tensor(1.0)
+    meter += torch.tensor(2.0)
+    meter.update_from_tensor(torch.tensor([3.0, 6.0]))
+    assert meter.count == 4
+    assert meter.avg() == 3.0
+
+    new_meter = meter + 8.0
+    assert new_meter.avg() == 4.0
+    assert meter.count == 4
+
+    meter.reset()
+    assert meter.total == 0.0
+    assert meter.avg() == 0.0
+
+
 class Metric:
+    """
+    Metrics of the training per channel and per epoch
+
+    The values of all metrics are stored into a single tensor with the
+    shape [num_metrics, num_channels, num_epochs], each metric is a row
+    of this tensor, which is also returned by the attribute named as
+    the metric.
+
+    :arg num_epochs: The number of epochs;
+    :arg num_channels: The number of channels (e.g. train and val);
+    :arg names: The names of the metrics.
+
+    :type num_epochs: `int`
+    :type num_channels: `int`
+    :type names: `list`
+    """
+    NAMES = ('mse_losses', 'kl_divergence_losses')
+
     @classmethod
     def load(cls, state_dict, new_num_epochs=None):
         """
@@ -891,37 +1673,49 @@ class Metric:
             return
         num_epochs = state_dict['num_epochs']
         num_channels = state_dict['num_channels']
+        if 'data' in state_dict:
+            names = state_dict['names']
+            values = torch.as_tensor(state_dict['data'])
+        else:
+            # State dict of the former format, with an array per metric
+            reserved = ('num_epochs', 'num_channels', 'channels')
+            names = [n for n in state_dict if n not in reserved]
+            values = torch.stack([
+                torch.as_tensor(state_dict[n], dtype=torch.float64)
+                for n in names])
+
         if new_num_epochs and new_num_epochs > num_epochs:
-            instance = cls(new_num_epochs, num_channels)
+            instance = cls(new_num_epochs, num_channels, names)
         else:
-            instance = cls(num_epochs, num_channels)
-        instance.channels = state_dict['channels']
-
-        del state_dict['num_epochs']
-        del state_dict['num_channels']
-        del state_dict['channels']
-
-        for name, values in state_dict.items():
-            metric = instance.__dict__[name]
-            for i in range(instance.num_channels):
-                metric[i, :num_epochs] = values[i, :num_epochs]
-            # logger.info(f"\n\t{name}: {metric}")
+            instance = cls(num_epochs, num_channels, names)
+        instance.channels = list(state_dict['channels'])
+        instance._data[:, :, :num_epochs] = values[:, :, :num_epochs]
         logger.info("Metric state dict is loaded successfully")
         return instance
 
-    def __init__(self, num_epochs, num_channels=2):
+    def __init__(self, num_epochs, num_channels=2, names=NAMES):
         self.num_epochs = num_epochs
         self.num_channels = num_channels
 
         self.channels = [f"ch_{c}" for c in range(self.num_channels)]
 
-        self.mse_losses = self.new_buffer()
-        self.kl_divergence_losses = self.new_buffer()
+        self._row = {name: i for i, name in enumerate(names)}
+        self._data = torch.full(
+            (len(self._row), num_channels, num_epochs), float('nan'),
+            dtype=torch.float64)
 
-    def new_buffer(self):
-        bf = np.zeros((self.num_channels, self.num_epochs))
-        bf[:] = np.nan
-        return bf
+    def __getattr__(self, name):
+        # Only called when the attribute is not found, e.g. metric names
+        row = self.__dict__.get('_row', {}).get(name)
+        if row is None:
+            raise AttributeError(
+                f"'{self.__class__.__name__}' object has no attribute"
+                f" '{name}'")
+        return self._data[row]
+
+    @property
+    def names(self):
+        return list(self._row)
 
     def channel_id(self, name):
         if name not in self.channels:
@@ -936,20 +1730,50 @@ class Metric:
             return
 
         for m_name, m_values in metric_values.items():
-            if not hasattr(self, m_name):
+            if m_name not in self._row:
                 logger.warning(f"Metric named {m_name} is not defined")
                 continue
+            row = self._row[m_name]
             if isinstance(m_values, dict):
                 for chn, m_value in m_values.items():
                     chi = self.channel_id(chn)
-                    self.__dict__[m_name][chi, epoch] = m_value
+                    self._data[row, chi, epoch] = m_value
             elif isinstance(m_values, list):
                 if len(m_values) != self.num_channels:
                     raise ValueError(
                         "The length of metric values list must be equal"
                         f"to number channels ({self.num_channels})")
-                for i in range(self.num_channels):
-                    self.__dict__[m_name][i, epoch] = m_values[i]
+                self._data[row, :, epoch] = torch.as_tensor(
+                    m_values, dtype=self._data.dtype)
+
+    def update_epoch(self, epoch, channel_idx, values):
+        """
+        Method to write the metric values of one channel for an epoch
+
+        :param epoch: The index of the epoch;
+        :param channel_idx: The index of the channel;
+        :param values: The metric values indexed by metric name.
+
+        :type epoch: `int`
+        :type channel_idx: `int`
+        :type values: `dict`
+        """
+        if not (0 <= epoch < self.num_epochs):
+            logger.warning(
+                "Epoch indexed is out of range. The max epoch indexable"
+                f" is {self.num_epochs}")
+            return
+        rows = []
+        row_values = []
+        for name, value in values.items():
+            if name not in self._row:
+                logger.warning(f"Metric named {name} is not defined")
+                continue
+            rows.append(self._row[name])
+            row_values.append(value)
+        # The values of all metrics are written at once
+        self._data[rows, channel_idx, epoch] = torch.as_tensor(
+            row_values, dtype=self._data.dtype)
 
     def state_dict(self):
         """
@@ -957,35 +1781,32 @@ class Metric:
 
         :rtype: `dict`
         """
-        return self.__dict__
+        return {
+            'num_epochs': self.num_epochs,
+            'num_channels': self.num_channels,
+            'channels': self.channels,
+            'names': self.names,
+            'data': self._data,
+        }
 
     def plot(self, save_path):
         """
-        Plot and save training curves
-        """
-        plt.figure(figsize=(12, 10))
-
-        # Plot losses
-        plt.subplot(2, 1, 1)
-        plt.plot(self.epochs, self.cross_entropy_losses, label='Train Loss')
-        plt.plot(self.epochs, self.val_losses, label='Validation Loss')
-        plt.xlabel('Epoch')
-        plt.ylabel('Loss')
-        plt.title('Training and Validation Loss')
-        plt.legend()
-        plt.grid(True)
-
-        # Plot angle errors
-        plt.subplot(2, 1, 2)
-        plt.plot(epochs, self.train_angles,
-                 label='Train Angle Error (rad)')
-        plt.plot(epochs, self.val_angles,
-                 label='Validation Angle Error (rad)')
-        plt.xlabel('Epoch')
-        plt.ylabel('Angle Error (radians)')
-        plt.title('Training and Validation Angle Error')
-        plt.legend()
-        plt.grid(True)
+        Plot and save training curves, a plot per metric with
+        a curve per channel
+        """
+        epochs = np.arange(1, self.num_epochs + 1)
+        data = self._data.numpy()
+        plt.figure(figsize=(12, 5 * len(self._row)))
+
+        for i, (name, row) in enumerate(self._row.items()):
+            plt.subplot(len(self._row), 1, i + 1)
+            for chi, channel in enumerate(self.channels):
+                plt.plot(epochs, data[row, chi], label=f'{channel}')
+            plt.xlabel('Epoch')
+            plt.ylabel(name)
+            plt.title(f'{name} per epoch')
+            plt.legend()
+            plt.grid(True)
 
         # Save the figure
         plt.tight_layout()
@@ -993,6 +1814,44 @@ class Metric:
         plt.close()
 
 
+def test_metric_update_epoch():
+    metric = Metric(4, 2)
+    metric.update_epoch(1, 0, {"mse_losses": 0.5})
+    metric.update_epoch(1, 1, {"mse_losses": 0.25})
+    assert metric.mse_losses[0, 1] == 0.5
+    assert metric.mse_losses[1, 1] == 0.25
+    assert torch.isnan(metric.mse_losses[:, 0]).all()
+    assert torch.isnan(metric.kl_divergence_losses).all()
+
+
+def test_metric_load():
+    metric = Metric(2, 2)
+    for epoch in range(2):
+        for channel in range(2):
+            value = epoch * 2 + channel + 1
+            metric.update_epoch(epoch, channel, {
+                "mse_losses": value / 10, "kl_divergence_losses": value})
+    loaded = Metric.load(metric.state_dict(), new_num_epochs=3)
+    assert loaded.num_epochs == 3
+    assert torch.equal(loaded.mse_losses[:, :2], metric.mse_losses)
+    assert torch.equal(
+        loaded.kl_divergence_losses[:, :2], metric.kl_divergence_losses)
+    assert torch.isnan(loaded.mse_losses[:, 2]).all()
+    assert torch.isnan(loaded.kl_divergence_losses[:, 2]).all()
+
+    # State dict of the former format
+    state_dict = {
+        'num_epochs': 2, 'num_channels': 2, 'channels': ['train', 'val'],
+        'mse_losses': np.array([[0.5, np.nan], [0.25, np.nan]]),
+        'kl_divergence_losses': np.full((2, 2), np.nan)}
+    loaded = Metric.load(state_dict)
+    assert loaded.channels == ['train', 'val']
+    assert loaded.mse_losses[0, 0] == 0.5
+    assert loaded.mse_losses[1, 0] == 0.25
+    assert torch.isnan(loaded.mse_losses[:, 1]).all()
+    assert torch.isnan(loaded.kl_divergence_losses).all()
+
+
 class KLDiv(nn.Module):
     def __init__(self, beta=0.00025):
         super().__init__()
@@ -1010,9 +1869,10 @@ class KLDiv(nn.Module):
         :type log_variance: torch.Tensor
         :rtype: torch.Tensor
         """
-        x = torch.sum(1 + log_variance - mean.pow(2) - log_variance.exp())
-        kl_divergence = -0.5 * x
-        output = self.beta * kl_divergence
+        # The scalings are applied on the reduced value, so only
+        # the element-wise terms are computed on the full tensors.
+        x = (1.0 + log_variance - mean * mean - log_variance.exp()).sum()
+        output = x * (-0.5 * self.beta)
         return output
 
 
@@ -1042,28 +1902,269 @@ class SPG:
         :type reconstructed: torch.Tensor
         :type references: torch.Tensor
         """
+        # Both batches are post-processed in the same way, so that
+        # they can be compared.
         references = self.post_process_fn(references)
         reconstructed = self.post_process_fn(reconstructed)
 
+        # The batches are copied to the host at once
+        reconstructed = reconstructed.detach().cpu().numpy()
+        references = references.detach().cpu().numpy()
+
         batch_size = reconstructed.shape[0]
-        iterator = zip(reconstructed, references)
         plt.figure()
 
-        for i, (recons, reference) in enumerate(iterator):
-            recons = recons.cpu().detach().numpy()
-            reference = reference.cpu().detach().numpy()
-
+        for i in range(batch_size):
             plt.subplot(2, batch_size, i + 1)
-            plt.imshow(reference)
+            plt.imshow(references[i])
 
             plt.subplot(2, batch_size, batch_size + i + 1)
-            plt.imshow(recons)
+            plt.imshow(reconstructed[i])
 
         plt.savefig(self.file_path)
+        plt.close()
         logger.info(
             "Samples generated from reconstructed images is saved"
             f"at {self.file_path}")
-        # plt.clf()
+
+
+class _PackedTensor:
+    """
+    Placeholder of a tensor packed into a shared state buffer
+    """
+    def __init__(self, index):
+        self.index = index
+
+
+def _flatten_state(state, tensors):
+    if isinstance(state, torch.Tensor):
+        tensors.append(state.detach())
+        return _PackedTensor(len(tensors) - 1)
+    if isinstance(state, dict):
+        return {key: _flatten_state(value, tensors)
+                for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_flatten_state(value, tensors) for value in state)
+    return deepcopy(state)
+
+
+def _unflatten_state(state, tensors):
+    if isinstance(state, _PackedTensor):
+        return tensors[state.index]
+    if isinstance(state, dict):
+        return {key: _unflatten_state(value, tensors)
+                for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_unflatten_state(value, tensors) for value in state)
+    return state
+
+
+class SharedState:
+    """
+    State packed into a single shared memory buffer
+
+    The tensors of a nested state (made of dicts, lists and tuples) are
+    copied into one shared memory buffer, so that the state is sent to
+    another process with a single shared memory handle, whatever the number
+    of tensors it contains.
+
+    :arg state: The state to pack, like a checkpoint dict;
+    :type state: `dict`
+    """
+    alignment = 64
+
+    def __init__(self, state):
+        tensors = []
+        self.skeleton = _flatten_state(state, tensors)
+
+        # The layout contains the offset, the shape and the type of tensors
+        self.layout = []
+        size = 0
+        for tensor in tensors:
+            size = math.ceil(size / self.alignment) * self.alignment
+            self.layout.append((size, tuple(tensor.shape), tensor.dtype))
+            size += tensor.numel() * tensor.element_size()
+
+        self.buffer = torch.empty(size, dtype=torch.uint8).share_memory_()
+        self._copy(tensors)
+
+    def _view(self, offset, shape, dtype):
+        num_bytes = math.prod(shape) * dtype.itemsize
+        view = self.buffer[offset:offset + num_bytes]
+        return view.view(dtype).view(shape)
+
+    def _copy(self, tensors):
+        for tensor, (offset, shape, dtype) in zip(tensors, self.layout):
+            self._view(offset, shape, dtype).copy_(tensor)
+
+    def update(self, state):
+        """
+        Method to copy a new state into the buffer, without allocation
+
+        :param state: The new state, its tensors must have the same shapes
+          and types than the tensors of the packed state;
+        :returns: False, if the state does not match the layout of the
+          buffer, in this case, the buffer is not modified.
+
+        :type state: `dict`
+        :rtype: `bool`
+        """
+        tensors = []
+        skeleton = _flatten_state(state, tensors)
+        if len(tensors) != len(self.layout):
+            return False
+        for tensor, (_, shape, dtype) in zip(tensors, self.layout):
+            if tuple(tensor.shape) != shape or tensor.dtype != dtype:
+                return False
+
+        self.skeleton = skeleton
+        self._copy(tensors)
+        return True
+
+    def unpack(self):
+        """
+        Method to rebuild the state, the tensors are copied out of
+        the shared memory buffer
+
+        :rtype: `dict`
+        """
+        tensors = [self._view(*item).clone() for item in self.layout]
+        return _unflatten_state(self.skeleton, tensors)
+
+
+def save_checkpoint(checkpoint, checkpoint_dir, epoch):
+    """
+    Function to save a training checkpoint into the checkpoint directory
+
+    :param checkpoint: The checkpoint data;
+    :param checkpoint_dir: The directory where the checkpoints are saved;
+    :param epoch: The epoch index of the checkpoint;
+
+    :type checkpoint: `dict`
+    :type checkpoint_dir: `str`
+    :type epoch: `int`
+    """
+    file_path = os.path.join(checkpoint_dir, "checkpoint.pth")
+    prev_file_path = os.path.join(checkpoint_dir, "checkpoint_prev.pth")
+    tmp_file_path = file_path + ".tmp"
+
+    # The checkpoint is written into a temporary file, then renamed, so
+    # that an interrupted save never replaces the last checkpoint.
+    # The previous checkpoint is kept by renaming it, without copy.
+    torch.save(checkpoint, tmp_file_path)
+    if os.path.isfile(file_path):
+        os.replace(file_path, prev_file_path)
+    os.replace(tmp_file_path, file_path)
+    logger.info(f"Checkpoint of epoch {epoch + 1} done successfully")
+
+
+def checkpoint_writer(queue, done, failures=None):
+    """
+    Function run by the process which saves the checkpoints in background
+
+    :param queue: The queue from which the checkpoints are received, as
+      tuples of shared state, checkpoint directory and epoch index.
+      A `None` value stops the process;
+    :param done: The event which is set when a checkpoint is written,
+      then its shared state buffer can be reused;
+    :param failures: The queue into which the failed saves are reported,
+      as tuples of epoch index and error message.
+
+    :type queue: `multiprocessing.Queue`
+    :type done: `multiprocessing.Event`
+    :type failures: `multiprocessing.Queue`
+    """
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        shared_state, checkpoint_dir, epoch = item
+        try:
+            checkpoint = shared_state.unpack()
+            done.set()
+            save_checkpoint(checkpoint, checkpoint_dir, epoch)
+        except Exception as e:  # noqa
+            done.set()
+            logger.exception(f"Checkpoint of epoch {epoch} is failed")
+            if failures is not None:
+                failures.put((epoch, f"{e.__class__.__name__}: {e}"))
+
+
+def test_shared_state():
+    import tempfile
+    import threading
+
+    def make_state(value):
+        return {
+            "epoch": 3,
+            "model": {
+                "weight": torch.full((4, 3, 5, 5), value).to(
+                    memory_format=torch.channels_last),
+                "num_batches": torch.tensor(7 + int(value)),
+            },
+            "steps": [torch.arange(5, dtype=torch.int64) * int(value),
+                      {"name": "adam", "lr": 1e-4}],
+            "pair": (torch.full((3,), value, dtype=torch.float64), None),
+        }
+
+    state = make_state(1.0)
+    shared_state = SharedState(state)
+    unpacked = shared_state.unpack()
+    assert unpacked["epoch"] == 3
+    assert torch.equal(unpacked["model"]["weight"], state["model"]["weight"])
+    assert unpacked["model"]["num_batches"].ndim == 0
+    assert unpacked["model"]["num_batches"].item() == 8
+    assert unpacked["steps"][0].dtype == torch.int64
+    assert torch.equal(unpacked["steps"][0], state["steps"][0])
+    assert unpacked["steps"][1] == {"name": "adam", "lr": 1e-4}
+    assert isinstance(unpacked["pair"], tuple)
+    assert unpacked["pair"][0].dtype == torch.float64
+    assert torch.equal(unpacked["pair"][0], state["pair"][0])
+    assert unpacked["pair"][1] is None
+
+    # The buffer is reused by a state of the same layout
+    buffer = shared_state.buffer
+    assert shared_state.update(make_state(2.0))
+    assert shared_state.buffer is buffer
+    unpacked = shared_state.unpack()
+    assert (unpacked["model"]["weight"] == 2.0).all()
+    assert unpacked["model"]["num_batches"].item() == 9
+    assert torch.equal(unpacked["steps"][0], torch.arange(5) * 2)
+
+    # The buffer is not modified by a state of another layout
+    other_state = make_state(3.0)
+    other_state["pair"] = (other_state["pair"][0].float(), None)
+    assert not shared_state.update(other_state)
+    other_state = make_state(3.0)
+    other_state["steps"].append(torch.zeros(2))
+    assert not shared_state.update(other_state)
+    assert (shared_state.unpack()["model"]["weight"] == 2.0).all()
+
+    # The checkpoints are written by the writer, the last two are kept
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoints = queue.Queue()
+        failures = queue.Queue()
+        done = threading.Event()
+        checkpoints.put((SharedState(make_state(1.0)), tmp_dir, 0))
+        checkpoints.put((shared_state, tmp_dir, 1))
+        # A failed save is reported to the training process
+        no_dir = os.path.join(tmp_dir, "no_dir")
+        checkpoints.put((shared_state, no_dir, 2))
+        checkpoints.put(None)
+        checkpoint_writer(checkpoints, done, failures)
+
+        assert done.is_set()
+        epoch, _ = failures.get_nowait()
+        assert epoch == 2
+        assert failures.empty()
+        assert sorted(os.listdir(tmp_dir)) == [
+            "checkpoint.pth", "checkpoint_prev.pth"]
+        last = torch.load(
+            os.path.join(tmp_dir, "checkpoint.pth"), weights_only=False)
+        prev = torch.load(
+            os.path.join(tmp_dir, "checkpoint_prev.pth"), weights_only=False)
+        assert (last["model"]["weight"] == 2.0).all()
+        assert (prev["model"]["weight"] == 1.0).all()
 
 
 class Trainer(Model):
@@ -1126,24 +2227,31 @@ class Trainer(Model):
         self.kl_div = None
         self.optimizer = None
         self.lr_scheduler = None
+        self.grad_scaler = None
 
         self.metric = None
         self.recon_loss = AvgMeter()
         self.kl_loss = AvgMeter()
 
-        self.gas = 128  # Gradiant Accumulation Steps
+        self.gas = 1  # Gradiant Accumulation Steps (number of batches)
         self.seed = 42  # Seed number for random generation
         self.num_epochs = 1
         self.batch_size = 1
 
-        self.gac = 0  # Gradient Accumulation Count
-
         self.checkpoint_dir = "checkpoints"
         self.resume_ckpt = None
         self.best_model = None
         self.epoch = 0
 
         self.spg = None
+        self.stager = None
+        self._device = None
+
+        self._ckpt_queue = None
+        self._ckpt_failures = None
+        self._ckpt_done = None
+        self._ckpt_process = None
+        self._ckpt_state = None
 
     def compile(self, args):
         """
@@ -1156,28 +2264,53 @@ class Trainer(Model):
         # torch.manual_seed(args.seed)
         # np.random.seed(args.seed)
         set_seed(args.seed)
+        if not args.deterministic:
+            set_perf_mode()
+
+        # The model must be moved to its device before the compilation
+        self._device = self.device()
 
         self.num_epochs = args.epochs
         self.batch_size = args.batch_size
-        self.gas = args.gas
-
-        train_ds_dir = args.train_ds_dir
-        val_ds_dir = args.val_ds_dir
-        img_size = self.config.img_size
-        if not os.path.isdir(train_ds_dir):
-            raise FileNotFoundError(
-                f"No such training set directory at {train_ds_dir}")
-        if not os.path.isdir(val_ds_dir):
-            raise FileNotFoundError(
-                f"No such validation set directory at {val_ds_dir}")
-        train_dataset = Dataset(train_ds_dir, img_size)
-        val_dataset = Dataset(val_ds_dir, img_size)
-
-        # Create data loaders
-        self.train_loader = data.DataLoader(
-            train_dataset, batch_size=args.batch_size, shuffle=True)
-        self.val_loader = data.DataLoader(
-            val_dataset, batch_size=args.batch_size, shuffle=False)
+        # The accumulation is given in number of samples
+        self.gas = max(1, args.gas // args.batch_size)
+
+        if args.packed_dir:
+            # The datasets are packed by `vae-pack-dataset`
+            train_dataset = MmapDataset(
+                os.path.join(args.packed_dir, "train.npy"))
+            val_dataset = MmapDataset(os.path.join(args.packed_dir, "val.npy"))
+            # The images are not resized on the device at each batch
+            for dataset in (train_dataset, val_dataset):
+                if tuple(dataset.img_size) != tuple(self.config.img_size):
+                    raise ValueError(
+                        f"The images of {dataset.file_path} are packed"
+                        f" with the size {list(dataset.img_size)}, but the"
+                        f" model expects {list(self.config.img_size)}."
+                        " Pack the dataset again with the model --img-size.")
+        else:
+            train_ds_dir = args.train_ds_dir
+            val_ds_dir = args.val_ds_dir
+            img_size = self.config.img_size
+            if not train_ds_dir or not os.path.isdir(train_ds_dir):
+                raise FileNotFoundError(
+                    f"No such training set directory at {train_ds_dir}")
+            if not val_ds_dir or not os.path.isdir(val_ds_dir):
+                raise FileNotFoundError(
+                    f"No such validation set directory at {val_ds_dir}")
+            train_dataset = Dataset(train_ds_dir, img_size)
+            val_dataset = Dataset(val_ds_dir, img_size)
+
+        # Create data loaders. The batches are not pinned by the loaders,
+        # they are copied into the page-locked buffers of the stager.
+        self.stager = BatchStager(self._device)
+        max_memory = args.in_memory_limit * 1024 ** 2
+        self.train_loader = create_loader(
+            train_dataset, args.batch_size, shuffle=True,
+            num_workers=args.num_workers, max_memory=max_memory)
+        self.val_loader = create_loader(
+            val_dataset, args.batch_size, shuffle=False,
+            num_workers=args.num_workers, max_memory=max_memory)
 
         # Set loss function
         self.mse_loss = nn.MSELoss()
@@ -1188,6 +2321,15 @@ class Trainer(Model):
             self.parameters(), lr=args.learning_rate,
             weight_decay=args.weight_decay)
 
+        # The gradient scaling is needed only by float16 mixed precision,
+        # bfloat16 has the same range as float32
+        amp_dtype = resolve_amp_dtype(self.config.amp_dtype)
+        use_grad_scaler = (self.config.use_amp
+                           and amp_dtype == torch.float16
+                           and self._device.type == 'cuda')
+        self.grad_scaler = torch.amp.GradScaler(
+            'cuda', enabled=use_grad_scaler)
+
         # Learning rate scheduler
         self.lr_scheduler = torch.optim.lr_scheduler.StepLR(
             self.optimizer, step_size=3, gamma=0.1)
@@ -1199,6 +2341,69 @@ class Trainer(Model):
         spg_file_path = os.path.join(self.checkpoint_dir, 'samples.jpg')
         self.spg = SPG(spg_file_path, self.output_function)
 
+        if args.compile:
+            # The modules are compiled in place, the state dicts have
+            # the same keys than the ones of the eager modules.
+            torch._dynamo.config.cache_size_limit = 16
+            self.compile_modules(mode=args.compile_mode, dynamic=False)
+            self.kl_div.compile(dynamic=False)
+
+        self.start_checkpoint_writer()
+
+    def start_checkpoint_writer(self):
+        """
+        Method to start the process which saves the checkpoints, so that
+        the training is not stopped while the checkpoints are written
+        """
+        if self._ckpt_process is not None:
+            return
+        context = mp.get_context('spawn')
+        self._ckpt_queue = context.Queue()
+        self._ckpt_failures = context.Queue()
+        self._ckpt_done = context.Event()
+        self._ckpt_done.set()
+        self._ckpt_process = context.Process(
+            target=checkpoint_writer,
+            args=(self._ckpt_queue, self._ckpt_done, self._ckpt_failures),
+            daemon=True)
+        self._ckpt_process.start()
+
+    def checkpoint_failures(self):
+        """
+        Method to get the checkpoints which the writer process has failed
+        to save since the last call, the failures are logged
+
+        :returns: The list of tuples of epoch index and error message.
+        :rtype: `list`
+        """
+        failures = []
+        while self._ckpt_failures is not None:
+            try:
+                failures.append(self._ckpt_failures.get_nowait())
+            except queue.Empty:
+                break
+        for epoch, message in failures:
+            logger.error(
+                f"The checkpoint of epoch {epoch + 1} is not saved"
+                f" by the writer process: {message}")
+        return failures
+
+    def stop_checkpoint_writer(self):
+        """
+        Method to stop the checkpoint writer process, it waits
+        until the pending checkpoints are written
+        """
+        if self._ckpt_process is None:
+            return
+        self._ckpt_queue.put(None)
+        self._ckpt_process.join()
+        self.checkpoint_failures()
+        self._ckpt_queue = None
+        self._ckpt_failures = None
+        self._ckpt_done = None
+        self._ckpt_process = None
+        self._ckpt_state = None
+
     @staticmethod
     def _update_losses(input_losses, output_losses):
         """
@@ -1243,20 +2448,41 @@ class Trainer(Model):
             # "best_performance": self.best_performance,
             **kwargs}
 
-        file_path1 = os.path.join(
-            self.checkpoint_dir, "checkpoint.pth")
-        file_path2 = os.path.join(
-            self.checkpoint_dir, f"checkpoint_{self.epoch}.pth")
-        torch.save(checkpoint, file_path1)
-        copy(file_path1, file_path2)
-        logger.info("Checkpoint done successfully")
-
-        if self.epoch >= 2:
-            old_checkpoint_file = os.path.join(
-                self.checkpoint_dir, f"checkpoint_{self.epoch - 2}.pth")
-            if os.path.isfile(old_checkpoint_file):
-                os.remove(old_checkpoint_file)
-                logger.info(f"{old_checkpoint_file} checkpoint is removed.")
+        if self._ckpt_process is None or not self._ckpt_process.is_alive():
+            save_checkpoint(checkpoint, self.checkpoint_dir, self.epoch)
+            return
+        if self.checkpoint_failures():
+            # The previous checkpoint is not saved, this one is saved
+            # here, so that an error like a full disk stops the training.
+            save_checkpoint(checkpoint, self.checkpoint_dir, self.epoch)
+            return
+
+        # The tensors are copied into shared memory, then the checkpoint
+        # is written by the writer process while the training continues.
+        # The shared memory buffer is allocated once and reused by the next
+        # checkpoints, after the writer has read the previous one.
+        while not self._ckpt_done.wait(timeout=5.0):
+            if not self._ckpt_process.is_alive():
+                save_checkpoint(checkpoint, self.checkpoint_dir, self.epoch)
+                return
+        if (self._ckpt_state is None
+                or not self._ckpt_state.update(checkpoint)):
+            self._ckpt_state = None
+            try:
+                self._ckpt_state = SharedState(checkpoint)
+            except (RuntimeError, OSError) as e:
+                # The shared memory is too small for the checkpoint
+                # (e.g. /dev/shm of a container), then the checkpoints
+                # are saved by the training process.
+                logger.warning(
+                    "The checkpoint can not be copied into shared memory,"
+                    f" it is saved synchronously: {e}")
+                self.stop_checkpoint_writer()
+                save_checkpoint(checkpoint, self.checkpoint_dir, self.epoch)
+                return
+        self._ckpt_done.clear()
+        self._ckpt_queue.put(
+            (self._ckpt_state, self.checkpoint_dir, self.epoch))
 
     def load_checkpoint(self):
         if not self.resume_ckpt:
@@ -1277,41 +2503,56 @@ class Trainer(Model):
         # self.best_performance = ckpt_data['best_performance']
         logger.info(f"Checkpoint loaded successfully from {self.resume_ckpt}!")
 
-    def train_step(self, images, targets, write_fn, optimize=False):
+    def train_step(self, images, targets, write_fn, step_idx, optimize=False):
         """
         Training method on one batch
-        """
-        # Forward pass
-        encoded, (mean, log_variance) = self.encoder(images)
-        reconstructed_image = self.decoder(encoded)
-
-        # Comput losses
-        reconstructed_loss = self.mse_loss(reconstructed_image, targets)
-        kl_divergence = self.kl_div(mean, log_variance)
-        loss = reconstructed_loss + kl_divergence
-
-        # Backward pass
-        loss.backward()
 
-        self.recon_loss += reconstructed_loss.item()
-        self.kl_loss += kl_divergence.item()
+        The gradients are accumulated over `gas` batches, the loss is
+        divided by `gas`, so that the accumulated gradient is the gradient
+        of the mean loss over these batches.
 
-        self.gac += len(images)
-        if self.gac >= self.gas or optimize:
-            self.optimizer.step()
-            self.optimizer.zero_grad()
-
-            write_fn(
-                "\t* Optim step"
-                f" - reconstruction loss: {self.recon_loss.avg():.8f}"
-                f" - KL loss: {self.kl_loss.avg():.8f}")
-            self.gac = 0
+        :param images: The input images;
+        :param targets: The target images;
+        :param write_fn: The function used to print the optimization steps;
+        :param step_idx: The index of the batch in the epoch;
+        :param optimize: Whether to force the optimization step, at the
+          last batch of the epoch;
+        """
+        # Forward pass, in mixed precision when it is enabled
+        with self.autocast(images.device):
+            encoded, (mean, log_variance) = self.encoder(images)
+            reconstructed_image = self.decoder(encoded)
+
+            # Comput losses
+            reconstructed_loss = self.mse_loss(reconstructed_image, targets)
+            kl_divergence = self.kl_div(mean, log_variance)
+            loss = (reconstructed_loss + kl_divergence) / self.gas
+
+        # Backward pass, the loss is scaled only for float16
+        self.grad_scaler.scale(loss).backward()
+
+        # The losses are accumulated on the device, without synchronization
+        self.recon_loss += reconstructed_loss.detach()
+        self.kl_loss += kl_divergence.detach()
+
+        if (step_idx + 1) % self.gas == 0 or optimize:
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
+            self.optimizer.zero_grad(set_to_none=True)
+
+            # The average losses are copied from the device and printed
+            # every 16 optimization steps only
+            num_steps = (step_idx + 1) // self.gas
+            if num_steps % 16 == 0 or optimize:
+                write_fn(
+                    "\t* Optim step"
+                    f" - reconstruction loss: {self.recon_loss.avg():.8f}"
+                    f" - KL loss: {self.kl_loss.avg():.8f}")
 
     def train_one_epoch(self):
         """
         Method of training on one epoch
         """
-        model_device = self.device()
         loss_data = {}
 
         self.recon_loss.reset()
@@ -1323,29 +2564,32 @@ class Trainer(Model):
         write_fn = iterator.write
 
         self.train()
-        self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none=True)
         for index, (images, targets) in enumerate(iterator):
-            images = images.to(model_device)  # noqa
-            targets = targets.to(model_device)
+            images, targets = self.stager(images, targets)
 
+            # The targets are the input images, they are preprocessed
+            # once when they are the same tensor.
+            is_input = targets is images
             images = self.input_function(images)
-            targets = self.input_function(targets)
+            targets = images if is_input else self.input_function(targets)
 
             # At last iteration, the gradient accumulation count can not
             # be equal to gradient accumulation step, so we must perform
             # optimization step when we are at the last iteration (length - 1)
             is_last_index = index >= (length - 1)
-            self.train_step(images, targets, write_fn, is_last_index)
+            self.train_step(images, targets, write_fn, index, is_last_index)
 
-            loss_data = {
-                "mse_losses": self.recon_loss.avg(),
-                "kl_divergence_losses": self.kl_loss.avg()}
-            iterator.set_postfix(loss_data)
+            # The average losses are copied from the device every 16 batches
+            if index % 16 == 0 or is_last_index:
+                loss_data = {
+                    "mse_losses": self.recon_loss.avg(),
+                    "kl_divergence_losses": self.kl_loss.avg()}
+                iterator.set_postfix(loss_data)
 
         return loss_data
 
     def validate(self):
-        model_device = self.device()
         loss_data = {}
         self.recon_loss.reset()
         self.kl_loss.reset()
@@ -1354,40 +2598,51 @@ class Trainer(Model):
         predictions = None
 
         self.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
+            length = len(self.val_loader)
+            # The index of the batch whose samples are generated
+            sample_idx = random.randrange(max(1, length))
             desc = "\033[43m    VALIDATION\033[0m"
             iterator = tqdm(self.val_loader, desc=desc)
 
-            for images, targets in iterator:
-                images = images.to(model_device)  # noqa
-                targets = targets.to(model_device)
+            for index, (images, targets) in enumerate(iterator):
+                images, targets = self.stager(images, targets)
 
+                # The targets are the input images, they are preprocessed
+                # once when they are the same tensor.
+                is_input = targets is images
                 images = self.input_function(images)
-                targets = self.input_function(targets)
-
-                # Forward pass
-                encoded, (mean, log_variance) = self.encoder(images)
-                reconstructed_image = self.decoder(encoded)
-
-                # Compute losses
-                reconstructed_loss = self.mse_loss(
-                    reconstructed_image, targets)
-                kl_divergence = self.kl_div(mean, log_variance)
-
-                self.recon_loss += reconstructed_loss.item()
-                self.kl_loss += kl_divergence.item()
-
-                loss_data.update({
-                    "mse_losses": self.recon_loss.avg(),
-                    "kl_divergence_losses": self.kl_loss.avg()})
-                iterator.set_postfix(loss_data)
-
-                random_val = np.random.rand()
-                if None in (predictions, references) and random_val < 0.3:
-                    references = targets
-                    predictions = reconstructed_image
-
-            self.spg.generate(reconstructed_image, targets)
+                targets = images if is_input else self.input_function(targets)
+
+                # Forward pass, in mixed precision when it is enabled
+                with self.autocast(self._device):
+                    encoded, (mean, log_variance) = self.encoder(images)
+                    reconstructed_image = self.decoder(encoded)
+
+                    # Compute losses
+                    reconstructed_loss = self.mse_loss(
+                        reconstructed_image, targets)
+                    kl_divergence = self.kl_div(mean, log_variance)
+
+                self.recon_loss += reconstructed_loss
+                self.kl_loss += kl_divergence
+
+                # The average losses are copied from the device
+                # every 16 batches
+                if index % 16 == 0 or index >= (length - 1):
+                    loss_data.update({
+                        "mse_losses": self.recon_loss.avg(),
+                        "kl_divergence_losses": self.kl_loss.avg()})
+                    iterator.set_postfix(loss_data)
+
+                if index == sample_idx:
+                    # The tensors are cloned, the output buffers of the
+                    # compiled modules can be overwritten by the next batch
+                    references = targets.clone()
+                    predictions = reconstructed_image.clone()
+
+            if predictions is not None:
+                self.spg.generate(predictions, references)
         return loss_data
 
     def fit(self):
@@ -1408,43 +2663,43 @@ class Trainer(Model):
             self.metric.channels[0] = "train"
             self.metric.channels[1] = "val"
 
-        self.output_function.to(self.device())
+        self.output_function.to(self._device)
 
-        for epoch in range(self.epoch, self.num_epochs):
-            self.epoch = epoch
-            logger.info(f'Epoch: {epoch + 1} / {self.num_epochs}:')
+        try:
+            for epoch in range(self.epoch, self.num_epochs):
+                self.epoch = epoch
+                logger.info(f'Epoch: {epoch + 1} / {self.num_epochs}:')
 
-            train_losses = self.train_one_epoch()
+                train_losses = self.train_one_epoch()
 
-            # Update the learning rate
-            self.lr_scheduler.step()
+                # Update the learning rate
+                self.lr_scheduler.step()
 
-            # Add losses to train losses epochs
-            # Save checkpoint with the current model state
-            # self._add_to_epoch_results(self.train_losses, train_losses)
-            self.metric[epoch] = {
-                name: {"train": value} for name, value in train_losses.items()}
+                # Add losses to train losses epochs
+                # Save checkpoint with the current model state
+                # self._add_to_epoch_results(self.train_losses, train_losses)
+                self.metric.update_epoch(epoch, 0, train_losses)
 
-            logger.info(f'{self.print_results(train_losses)}')
+                logger.info(f'{self.print_results(train_losses)}')
 
-            # Make checkpoint after training
-            self.checkpoint()
+                val_losses = self.validate()
 
-            val_losses = self.validate()
+                # self.add_to_epoch_results(self.val_losses, val_losses)
+                self.metric.update_epoch(epoch, 1, val_losses)
 
-            # self.add_to_epoch_results(self.val_losses, val_losses)
-            self.metric[epoch] = {
-                name: {"val": value} for name, value in val_losses.items()}
+                logger.info(f'{self.print_results(val_losses)}')
 
-            logger.info(f'{self.print_results(val_losses)}')
+                # Make checkpoint after validation
+                self.checkpoint()
 
-            # Make checkpoint after validation
-            self.checkpoint()
-
-            if epoch != (self.num_epochs - 1):
-                # Epochs are remaining
-                logger.info(("-" * 80) + "\n")
-                clear_console()
+                if epoch != (self.num_epochs - 1):
+                    # Epochs are remaining
+                    logger.info(("-" * 80) + "\n")
+                    clear_console()
+        finally:
+            # Wait until the last checkpoints are written
+            self.stop_checkpoint_writer()
+            self.stager.release()
 
         self.save_encoder("vae_encoder")
         self.save_decoder("vae_decoder")
@@ -1459,9 +2714,21 @@ def parse_argument():
     """
     parser = ArgumentParser(prog="VAE Train")
     parser.add_argument('--seed', type=int, default=42)
-    parser.add_argument('-dt', '--train-ds-dir', type=str, required=True)
-    parser.add_argument('-dv', '--val-ds-dir', type=str, required=True)
+    parser.add_argument(
+        '--deterministic', action='store_true',
+        help="Disable cuDNN autotuning and TF32 for reproducible results")
+    parser.add_argument('-dt', '--train-ds-dir', type=str)
+    parser.add_argument('-dv', '--val-ds-dir', type=str)
+    parser.add_argument(
+        '--packed-dir', type=str,
+        help="Directory of train.npy and val.npy written by vae-pack-dataset,"
+             " used instead of the dataset directories")
     parser.add_argument('-b', '--batch-size', type=int, default=1)
+    parser.add_argument(
+        '--num-workers', type=int, default=min(8, (os.cpu_count() or 2) // 2))
+    parser.add_argument(
+        '--in-memory-limit', type=int, default=1024,
+        help="Max size in MB of a dataset to load it in memory (0 disables)")
 
     # img_channels = 3
     # img_size = [224, 224]
@@ -1480,12 +2747,32 @@ def parse_argument():
     parser.add_argument('--in-proj-bias', type=bool, default=True)
     parser.add_argument('--out-proj-bias', type=bool, default=True)
     parser.add_argument('--mult-factor', type=float, default=0.18215)
+    parser.add_argument(
+        '--upsample-mode', type=str, default='nearest_conv',
+        choices=['nearest_conv', 'convt'])
+    parser.add_argument(
+        '--no-amp', action='store_true',
+        help="Disable the mixed precision on CUDA devices")
+    parser.add_argument(
+        '--amp-dtype', type=str, default='auto',
+        choices=['auto', 'bfloat16', 'float16'],
+        help="Type of the mixed precision, auto selects bfloat16 on the"
+             " GPUs which support it natively, float16 otherwise")
 
     parser.add_argument('-n', '--epochs', type=int, default=2)
     parser.add_argument('-lr', '--learning-rate', type=float, default=1e-4)
     parser.add_argument('--weight-decay', type=float, default=0.0005)
     parser.add_argument('-kl-weight', type=float, default=0.00025)
-    parser.add_argument('-gas', type=int, default=128)
+    parser.add_argument(
+        '-gas', type=int, default=128,
+        help="Number of samples accumulated per optimization step")
+
+    parser.add_argument(
+        '--compile', action='store_true',
+        help="Compile the encoder and the decoder with torch.compile")
+    parser.add_argument(
+        '--compile-mode', type=str, default='max-autotune',
+        choices=['default', 'reduce-overhead', 'max-autotune'])
 
     parser.add_argument('-r', "--resume", type=str)
     parser.add_argument('--checkpoint-dir', type=str, default='checkpoints')
@@ -1494,6 +2781,10 @@ def parse_argument():
     parser.add_argument('--best-model', type=str, default="best")
 
     args = parser.parse_args()
+    if not args.packed_dir and not (args.train_ds_dir and args.val_ds_dir):
+        parser.error(
+            "the arguments -dt/--train-ds-dir and -dv/--val-ds-dir are"
+            " required, unless --packed-dir is provided")
     logger.info("Training arguments:")
     for arg, value in vars(args).items():
         logger.info(f"  {arg}: {value}")
@@ -1526,16 +2817,45 @@ def main():
         config.in_proj_bias = args.in_proj_bias
         config.out_proj_bias = args.out_proj_bias
         config.mult_factor = args.mult_factor
+        config.upsample_mode = args.upsample_mode
+        config.use_amp = not args.no_amp
+        config.amp_dtype = args.amp_dtype
 
         model = Trainer(config)
 
     model = model.to(device)
 
-    model.compile(args)
+    # The summary runs forward passes, it is printed before the modules
+    # are compiled, so that it does not trigger another compilation.
     model.summary(args.batch_size)
+    model.compile(args)
     model.fit()
 
 
+def pack_main():
+    """
+    Main function to pack the training and validation sets into
+    NumPy files read by memory mapping
+    """
+    parser = ArgumentParser(prog="VAE Pack Dataset")
+    parser.add_argument('-dt', '--train-ds-dir', type=str, required=True)
+    parser.add_argument('-dv', '--val-ds-dir', type=str, required=True)
+    parser.add_argument('--img-size', type=int, default=224)
+    parser.add_argument('-o', '--output-dir', type=str, required=True)
+    args = parser.parse_args()
+
+    img_size = [args.img_size, args.img_size]
+    os.makedirs(args.output_dir, exist_ok=True)
+    for name, dataset_dir in (("train", args.train_ds_dir),
+                              ("val", args.val_ds_dir)):
+        if not os.path.isdir(dataset_dir):
+            raise FileNotFoundError(
+                f"No such dataset directory at {dataset_dir}")
+        file_path = os.path.join(args.output_dir, f"{name}.npy")
+        num_images = pack_dataset(Dataset(dataset_dir, img_size), file_path)
+        logger.info(f"{num_images} images are packed into {file_path}")
+
+
 if __name__ == '__main__':
     try:
         main()